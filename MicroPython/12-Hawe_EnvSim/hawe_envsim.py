@@ -79,10 +79,15 @@ def mqtt_callback(topic, msg):
 def check_entity_existence():
     global mqtt
     
+    config_topics = [
+        TOPIC_CONFIG_TEMPERATURE,
+        TOPIC_CONFIG_HUMIDITY,
+        TOPIC_CONFIG_PRESSURE
+    ]
+
     mqtt.set_callback(mqtt_callback)
-    mqtt.subscribe(TOPIC_CONFIG_TEMPERATURE)
-    mqtt.subscribe(TOPIC_CONFIG_HUMIDITY)
-    mqtt.subscribe(TOPIC_CONFIG_PRESSURE)
+    # One SUBSCRIBE packet for all config topics
+    mqtt.subscribe_many([(topic, 0) for topic in config_topics])
 
     print("[check_entity_existence] Waiting for retained config messages...")
 
@@ -95,6 +100,9 @@ def check_entity_existence():
             break
         time.sleep(0.1)
 
+    # The config topics are only needed for this check
+    mqtt.unsubscribe_many(config_topics)
+
     print(f"[check_entity_existence] Result: {state_received}")
     return all(state_received.values())
 
@@ -166,9 +174,12 @@ def publish_sensor():
     hum_str = "{:.2f}".format(random.randint(40, 70))
     press_str = "{:.2f}".format(random.randint(990, 1100))
 
-    mqtt.publish(TOPIC_STATE_TEMPERATURE, temp_str, retain=True)
-    mqtt.publish(TOPIC_STATE_HUMIDITY, hum_str, retain=True)
-    mqtt.publish(TOPIC_STATE_PRESSURE, press_str, retain=True)
+    # Send the three states with one socket write
+    mqtt.publish_many([
+        (TOPIC_STATE_TEMPERATURE, temp_str, True, 0),
+        (TOPIC_STATE_HUMIDITY, hum_str, True, 0),
+        (TOPIC_STATE_PRESSURE, press_str, True, 0),
+    ])
 
     print(f"[publish_sensor] t={temp_str}, h={hum_str}, p={press_str}")
 
@@ -142,10 +142,15 @@ def mqtt_callback_retained(topic, msg):
 def check_entity_existence():
     global mqtt
     
+    config_topics = [
+        TOPIC_CONFIG_TEMPERATURE,
+        TOPIC_CONFIG_HUMIDITY,
+        TOPIC_CONFIG_DEWPOINT
+    ]
+
     mqtt.set_callback(mqtt_callback_retained)
-    mqtt.subscribe(TOPIC_CONFIG_TEMPERATURE)
-    mqtt.subscribe(TOPIC_CONFIG_HUMIDITY)
-    mqtt.subscribe(TOPIC_CONFIG_DEWPOINT)
+    # One SUBSCRIBE packet for all config topics
+    mqtt.subscribe_many([(topic, 0) for topic in config_topics])
 
     print("[check_entity_existence] Waiting for retained config messages...")
 
@@ -158,6 +163,9 @@ def check_entity_existence():
             break
         time.sleep(0.1)
 
+    # The config topics are only needed for this check
+    mqtt.unsubscribe_many(config_topics)
+
     print(f"[check_entity_existence] Result: {state_received}")
     return all(state_received.values())
 
@@ -170,6 +170,7 @@ def publish_discovery():
         "availability_topic": TOPIC_AVAILABILITY,
         "schema": "json",
         "brightness": True,
+        "qos": 2,
         "device": {
             "name": DEVICE_NAME,
             "identifiers": [DEVICE_ID]
@@ -186,8 +187,8 @@ def publish_discovery():
 # ---- MQTT SUBSCRIBE ----
 def subscribe_command():
     global mqtt
-    # MQTT Subscribe to command changes from HA
-    mqtt.subscribe(TOPIC_COMMAND_LIGHT) 
+    # MQTT Subscribe to command changes from HA, QoS 2 = exactly once
+    mqtt.subscribe(TOPIC_COMMAND_LIGHT, 2)
     print(f"[subscribe_command] topic={TOPIC_COMMAND_LIGHT}")
 
 def read_encoder():
@@ -236,9 +236,11 @@ def publish_discovery():
 
 def subscribe_topics():
     global mqtt
-    mqtt.subscribe(TOPIC_CMD_RED)
-    mqtt.subscribe(TOPIC_CMD_YELLOW)
-    mqtt.subscribe(TOPIC_CMD_GREEN)
+    mqtt.subscribe_many([
+        (TOPIC_CMD_RED, 0),
+        (TOPIC_CMD_YELLOW, 0),
+        (TOPIC_CMD_GREEN, 0)
+    ])
     print("[subscribe_topics] Subscribed to red, yellow, green")
 
 def main_loop():
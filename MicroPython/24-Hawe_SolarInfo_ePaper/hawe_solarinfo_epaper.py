@@ -49,6 +49,7 @@ import gc
 import secrets
 import connect
 import utils
+import bootseq
 
 # ePaper
 from solar_display import SolarDisplay
@@ -65,9 +66,6 @@ DEVICE_ID = "solarinfo"
 # Log device name & id
 print(f"[initialize][device] name={DEVICE_NAME}, id={DEVICE_ID}")
 
-# Start with onboard LED, blink until initialization completed.
-utils.onboard_led_blink(times=2)
-
 # ---- ePaper ----
 TITLE = "Solar Info"
 # Globals for the epaper
@@ -219,18 +217,21 @@ def main_loop():
 def main():
     global wlan,mqtt,epaper_ok
     
+    # Onboard LED blinks until initialization completed
+    boot = bootseq.BootSequence()
     try:
-        # Init ePaper display first
-        epaper_ok = init_epaper()       
+        # Start the WiFi join first, it proceeds during the ePaper init and refresh
+        boot.start_wifi()
+
+        epaper_ok = bool(boot.step("epaper", init_epaper))
         if not epaper_ok:
             print("[main] ePaper not available — continuing without display.")
         
+        # Single splash, each full refresh takes seconds
         if epaper_ok:
-            epaper.display_wait(TITLE, "Connecting WiFi...")    
-        wlan = connect.connect_wifi()
+            boot.step("splash", epaper.display_wait, TITLE, "Waiting for data...", 0)
 
-        if epaper_ok:
-            epaper.display_wait(TITLE, "Connecting MQTT...")
+        wlan = boot.wait_wifi()
 
         mqtt = connect.connect_mqtt(
             MQTT_CLIENT_ID,
@@ -243,15 +244,13 @@ def main():
 
         subscribe_command()
 
-        utils.onboard_led_on()
-        
-        if epaper_ok:
-            epaper.display_wait(TITLE, "Ready. Waiting for data...")
+        boot.ready()
 
         main_loop()
 
     except Exception as e:
         print(f"[ERROR] Initialization failed: {e}")
+        boot.failed()
         utils.onboard_led_blink(times=10)
 
 # Start main
@@ -22,14 +22,12 @@ Script Output:
 [publish_status] topic=hawe/picostatus/rssi,rssi=-54
 [publish_status] topic=hawe/picostatus/online,online=1
 
-[mqtt_callback] topic=hawe/picostatus/cmd/request_status
 [mqtt_callback] publishing status...
 [publish_status] topic=hawe/picostatus/uptime,time=1750585289
 [publish_status] topic=hawe/picostatus/ip,ip=192.168.1.153
 [publish_status] topic=hawe/picostatus/rssi,rssi=-37
 [publish_status] topic=hawe/picostatus/online,online=1
 
-[mqtt_callback] topic=hawe/picostatus/cmd/toggle_led
 [mqtt_callback] toggle led...
 """
 
@@ -46,6 +44,10 @@ import gc
 import secrets
 import connect
 import utils
+import bootprof
+from umqtt.dispatch import Dispatcher
+
+bootprof.mark("import")
 
 # ---- GLOBALS ----
 wlan = None
@@ -58,9 +60,19 @@ DEVICE_NAME = "Hawe PicoStatus"
 DEVICE_ID = "picostatus"
 # Log device name & id
 print(f"[initialize][device] name={DEVICE_NAME}, id={DEVICE_ID}")
+# Home Assistant device info, shared by all discovery configs
+DEVICE_INFO = {
+    "identifiers": [DEVICE_ID],
+    "name": DEVICE_NAME,
+    "manufacturer": "Hawe",
+    "model": "Raspberry Pi Pico 2 W"
+}
+# Boot phases marked with bootprof.mark()
+BOOT_PHASES = ("import", "led", "wifi", "mqtt", "availability", "subscribe")
 
 # Start with onboard LED, blink until initialization completed.
 utils.onboard_led_blink(times=2)
+bootprof.mark("led")
 
 # Get the time_ms
 start_ms = time.ticks_ms()
@@ -112,12 +124,7 @@ def publish_availability():
 def publish_discovery():
     global mqtt
 
-    device_info = {
-        "identifiers": [DEVICE_ID],
-        "name": DEVICE_NAME,
-        "manufacturer": "Hawe",
-        "model": "Raspberry Pi Pico 2 W"
-    }
+    device_info = DEVICE_INFO
 
     # Sensor & binary_sensor configs
     configs = [
@@ -194,6 +201,10 @@ def publish_discovery():
         print(f"[publish_discovery] added topic={topic}")
         time.sleep(2)
 
+    # Diagnostic sensors for the boot phase durations
+    bootprof.publish_discovery(mqtt, f"{secrets.BASE_TOPIC}/{DEVICE_ID}", DEVICE_INFO, BOOT_PHASES)
+    print(f"[publish_discovery] added boot phase sensors")
+
 # ---- Publish all state ----
 def publish_status():
     global start_ms, wlan, mqtt
@@ -217,24 +228,24 @@ def subscribe_topics():
     global mqtt
     print(f"[subscribe_topics] {TOPIC_COMMAND_REQUEST_STATUS}")
     print(f"[subscribe_topics] {TOPIC_COMMAND_TOGGLE_LED}")
-    mqtt.subscribe(TOPIC_COMMAND_REQUEST_STATUS)
-    mqtt.subscribe(TOPIC_COMMAND_TOGGLE_LED)
+    mqtt.subscribe_many([
+        (TOPIC_COMMAND_REQUEST_STATUS, 0),
+        (TOPIC_COMMAND_TOGGLE_LED, 0)
+    ])
 
 # ---- Handle commands ----
-def mqtt_callback(topic, msg):
-    topic = topic.decode()
-    msg = msg.decode()
-    
-    print(f"[mqtt_callback] topic={topic}")
-    # print(f"[mqtt_callback] topic={topic},msg={msg}")
-    
-    if topic.endswith("cmd/request_status"):
-        print(f"[mqtt_callback] publishing status...")
-        publish_status()
+def on_request_status(topic, msg):
+    print(f"[mqtt_callback] publishing status...")
+    publish_status()
+
+def on_toggle_led(topic, msg):
+    print(f"[mqtt_callback] toggle led...")
+    utils.onboard_led_toggle()
 
-    elif topic.endswith("cmd/toggle_led"):
-        print(f"[mqtt_callback] toggle led...")
-        utils.onboard_led_toggle()
+# Route the command topics to their handlers (no topic decoding needed)
+mqtt_callback = Dispatcher()
+mqtt_callback.add(TOPIC_COMMAND_REQUEST_STATUS, on_request_status)
+mqtt_callback.add(TOPIC_COMMAND_TOGGLE_LED, on_toggle_led)
 
 # --- MAIN ---
 def main_loop():
@@ -257,6 +268,7 @@ def main():
     
     # WiFi Connect
     wlan = connect.connect_wifi()
+    bootprof.mark("wifi")
 
     # MQTT Connect
     mqtt = connect.connect_mqtt(MQTT_CLIENT_ID,
@@ -264,9 +276,11 @@ def main():
         last_will_topic=TOPIC_AVAILABILITY,
         last_will_message="offline"
     )
+    bootprof.mark("mqtt")
 
     # 
     publish_availability()
+    bootprof.mark("availability")
 
     # Publish the MQTT disocvery topics
     # DO THIS ONLY if not created earlier else settings will be changed in HA
@@ -275,10 +289,14 @@ def main():
 
     # Subscribe to the topics send by HA
     subscribe_topics()
+    bootprof.mark("subscribe")
 
     # Turn the onboard led on
     utils.onboard_led_on()
 
+    # Publish the boot phase durations (sensors see publish_discovery())
+    bootprof.publish(mqtt, f"{secrets.BASE_TOPIC}/{DEVICE_ID}")
+
     # Run the main loop
     main_loop()
     print("[main] main_loop started")
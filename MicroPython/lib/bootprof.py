@@ -0,0 +1,108 @@
+"""
+bootprof.py
+Boot phase profiler for Raspberry Pi Pico W (MicroPython)
+
+Records a ticks_us timestamp at the end of each named boot phase and
+publishes the phase durations once the device is connected. The Home
+Assistant sensors for them are created with publish_discovery(), along
+with the other discovery configs of the device.
+
+Usage Example:
+--------------
+import bootprof
+
+wlan = connect.connect_wifi()
+bootprof.mark("wifi")
+mqtt = connect.connect_mqtt(...)
+bootprof.mark("mqtt")
+subscribe_topics()
+bootprof.mark("subscribe")
+
+# hawe/picostatus/boot: {"phases": {"wifi": 2310, ...}, "total": 3480}
+bootprof.publish(mqtt, f"{secrets.BASE_TOPIC}/picostatus")
+
+# Once, with the other discovery configs: one HA sensor per phase
+bootprof.publish_discovery(mqtt, f"{secrets.BASE_TOPIC}/picostatus", device_info, ("wifi", "mqtt", "subscribe"))
+"""
+
+import time
+import json
+from array import array
+
+import secrets
+
+# Maximum number of boot phases, further marks are ignored
+MAX_PHASES = 16
+
+# Phase names and their end timestamps, ticks_us counts from reset
+_names = [None] * MAX_PHASES
+_ticks = array("l", [0] * MAX_PHASES)
+_count = 0
+
+def mark(name):
+    """
+    Records the end of a boot phase. The phase starts where the previous
+    one ended, the first one at reset.
+
+    :param name: Phase name, used as JSON key and sensor name
+    """
+    global _count
+    if _count < MAX_PHASES:
+        _ticks[_count] = time.ticks_us()
+        _names[_count] = name
+        _count += 1
+
+def phases():
+    """
+    Returns the recorded phases.
+
+    :return: List of (name, duration_ms) tuples in boot order
+    """
+    result = []
+    t = 0
+    for i in range(_count):
+        result.append((_names[i], time.ticks_diff(_ticks[i], t) // 1000))
+        t = _ticks[i]
+    return result
+
+def publish(mqtt, base_topic):
+    """
+    Publishes the phase durations, retained, as JSON to {base_topic}/boot.
+
+    :param mqtt: Connected MQTTClient
+    :param base_topic: Topic prefix of the device, e.g. hawe/picostatus
+    """
+    p = phases()
+    total = _count and time.ticks_diff(_ticks[_count - 1], 0) // 1000
+    topic = f"{base_topic}/boot"
+    payload = json.dumps({"phases": dict(p), "total": total})
+    print(f"[bootprof] topic={topic}, payload={payload}")
+    mqtt.publish(topic, payload, retain=True)
+
+def publish_discovery(mqtt, base_topic, device, names):
+    """
+    Publishes Home Assistant discovery configs, retained, with one
+    diagnostic sensor per boot phase and one for the total. Like other
+    discovery configs, publish these once and not on every boot.
+
+    :param mqtt: Connected MQTTClient
+    :param base_topic: Topic prefix of the device, e.g. hawe/picostatus
+    :param device: HA device info dict with "identifiers" and "name"
+    :param names: Names of the phases marked during boot
+    """
+    topic = f"{base_topic}/boot"
+    node = base_topic.replace("/", "_")
+    for name in list(names) + ["total"]:
+        template = "value_json.total" if name == "total" else f"value_json.phases.{name}"
+        cfg = {
+            "name": f"{device['name']} Boot {name}",
+            "device_class": "duration",
+            "unit_of_measurement": "ms",
+            "entity_category": "diagnostic",
+            "state_topic": topic,
+            "value_template": "{{ " + template + " }}",
+            "object_id": f"{node}_boot_{name}",
+            "unique_id": f"{node}_boot_{name}",
+            "device": device
+        }
+        mqtt.publish(f"{secrets.DISCOVERY_PREFIX}/sensor/{node}_boot_{name}/config", json.dumps(cfg), retain=True)
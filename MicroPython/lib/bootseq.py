@@ -0,0 +1,102 @@
+"""
+bootseq.py
+Overlapped boot sequence for Raspberry Pi Pico W (MicroPython)
+
+Starts the WiFi join without waiting, blinks the onboard LED from a
+timer and runs the display and sensor initialization while the WiFi
+associates. Only wait_wifi() waits, where the network is really needed,
+so the boot takes about as long as the slowest step instead of the sum
+of all of them.
+
+Usage Example:
+--------------
+import bootseq
+
+boot = bootseq.BootSequence()
+boot.start_wifi()
+display_ok = boot.step("display", init_display)
+boot.step("splash", show_splash)
+wlan = boot.wait_wifi()
+mqtt = connect.connect_mqtt(...)
+boot.ready()
+"""
+
+import time
+import machine
+
+import connect
+import utils
+
+class BootSequence:
+    def __init__(self, blink_ms=200):
+        """
+        Starts blinking the ONBOARD_LED until ready() is called.
+
+        :param blink_ms: LED toggle period in ms
+        """
+        self.wlan = None
+        self._start = time.ticks_ms()
+        self._timer = machine.Timer(period=blink_ms, mode=machine.Timer.PERIODIC,
+                                    callback=lambda t: utils.onboard_led_toggle())
+
+    def elapsed_ms(self):
+        """
+        Returns the time since the boot sequence started in ms.
+        """
+        return time.ticks_diff(time.ticks_ms(), self._start)
+
+    def start_wifi(self):
+        """
+        Starts the WiFi join, see connect.start_wifi().
+
+        :return: network.WLAN object, possibly still associating
+        """
+        self.wlan = connect.start_wifi()
+        return self.wlan
+
+    def step(self, name, func, *args):
+        """
+        Runs one initialization step while the WiFi associates and logs
+        its duration. A failing step is logged and returns None, so the
+        boot continues without it.
+
+        :param name: Step name for the log
+        :param func: Function to call with args
+        :return: The function's result or None
+        """
+        start = time.ticks_ms()
+        try:
+            result = func(*args)
+        except Exception as e:
+            utils.log("boot", f"{name} failed: {e}")
+            result = None
+        wifi = self.wlan is not None and self.wlan.isconnected()
+        utils.log("boot", f"{name} {time.ticks_diff(time.ticks_ms(), start)} ms, wifi={'up' if wifi else 'joining'}")
+        return result
+
+    def wait_wifi(self):
+        """
+        Waits until the WiFi is connected, see connect.wait_wifi().
+
+        :return: network.WLAN object (connected instance)
+        """
+        if self.wlan is None:
+            self.start_wifi()
+        self.wlan = connect.wait_wifi(self.wlan)
+        utils.log("boot", f"wifi ready after {self.elapsed_ms()} ms")
+        return self.wlan
+
+    def ready(self):
+        """
+        Ends the boot sequence: stops blinking and turns the ONBOARD_LED on.
+        """
+        self._timer.deinit()
+        utils.onboard_led_on()
+        utils.log("boot", f"ready after {self.elapsed_ms()} ms")
+
+    def failed(self):
+        """
+        Stops blinking and turns the ONBOARD_LED off.
+        """
+        self._timer.deinit()
+        utils.onboard_led_off()
@@ -19,40 +19,268 @@ mqtt = connect.connect_mqtt("pico_experiment1",
 mqtt.publish(f"{secrets.BASE_TOPIC}/availability", "online")
 """
 
+import binascii
+import json
 import network
+import socket
 import time
 import secrets
 from umqtt.robust import MQTTClient
 
-# Maximum number of retries for WiFi and MQTT connections
-WIFI_RETRIES = 20
+# Maximum time for a full WiFi join in ms, and number of MQTT retries
+WIFI_TIMEOUT_MS = 10000
 MQTT_RETRIES = 5
 
-def connect_wifi():
+# WiFi fast rejoin: BSSID and channel of the last successful join are
+# kept in WIFI_CACHE and reused on the next boot, skipping the AP scan
+# (the join goes straight to that channel instead of scanning them all).
+# The IP config always comes from DHCP (or WIFI_STATIC_IP), a lease is
+# never reused as it may have expired. If the rejoin fails within
+# WIFI_FAST_JOIN_MS, a full join follows. The association is polled
+# every WIFI_POLL_MS.
+WIFI_CACHE = "wifi_cache.json"
+WIFI_FAST_JOIN_MS = 3000
+WIFI_POLL_MS = 50
+
+# Join started by start_wifi(): 0 = none, 1 = fast rejoin, 2 = full join,
+# with its start time, the cache it was based on and the AP a full join
+# picked from its scan as (bssid, channel)
+_wifi_join = 0
+_wifi_start = 0
+_wifi_cache = None
+_wifi_ap = (None, None)
+
+# MQTT keepalive in seconds. The client pings the broker from check_msg()
+# and treats the connection as dead after unanswered pings.
+MQTT_KEEPALIVE = 30
+
+# Upper bound in ms for any blocking MQTT call (connect, writes, subscribe,
+# QoS 1 publish, wait_msg incl. reconnects). Exceeding it raises
+# umqtt.simple.MQTTTimeout.
+MQTT_TIMEOUT_MS = 10000
+
+# Broker addresses resolved by resolve() are reused for MQTT_DNS_TTL
+# seconds, and beyond that while DNS lookups fail.
+MQTT_DNS_TTL = 3600
+_dns_cache = {}
+
+# TLS context and session of the last broker connection. connect_mqtt()
+# offers the session to the broker so reconnects can skip the full
+# handshake; robust reconnects reuse the client's own session. Only
+# where the ssl module supports sessions (CPython), MicroPython's ssl
+# always does the full handshake.
+_tls_ctx = None
+_tls_session = None
+
+def _wait_wifi(wlan, timeout_ms):
     """
-    Connects to the WiFi using credentials from secrets.py.
+    Waits for the WiFi association, polling every WIFI_POLL_MS.
 
     Returns:
-        network.WLAN object (connected instance)
+        True if connected within timeout_ms of the join start, False if not or the join failed.
+    """
+    while not wlan.isconnected():
+        if wlan.status() < 0 or time.ticks_diff(time.ticks_ms(), _wifi_start) > timeout_ms:
+            return False
+        time.sleep_ms(WIFI_POLL_MS)
+    return True
 
-    Raises:
-        RuntimeError if unable to connect after WIFI_RETRIES.
+def _load_wifi_cache():
+    """
+    Reads the fast rejoin data saved by _save_wifi_cache().
+
+    Returns:
+        dict with ssid, bssid and channel, or None if there is none for WIFI_SSID.
+    """
+    try:
+        with open(WIFI_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get("ssid") != secrets.WIFI_SSID:
+        return None
+    return cache
+
+def _save_wifi_cache(cache):
     """
+    Saves BSSID and channel of the AP picked by the last full join to
+    flash, if they changed.
+
+    Args:
+        cache (dict): Previously saved data or None.
+    """
+    data = {
+        "ssid": secrets.WIFI_SSID,
+        "bssid": _wifi_ap[0],
+        "channel": _wifi_ap[1],
+    }
+    if data != cache:
+        try:
+            with open(WIFI_CACHE, "w") as f:
+                json.dump(data, f)
+        except OSError as e:
+            print(f"[connect_wifi] Saving {WIFI_CACHE} failed: {e}")
+
+def _full_join(wlan):
+    """
+    Starts a full join, with DHCP unless WIFI_STATIC_IP is set. The scan
+    picks the strongest AP of WIFI_SSID and the join goes to it, so the
+    BSSID and channel for the cache need no second scan. A hidden network
+    is joined by SSID.
+    """
+    global _wifi_join, _wifi_start, _wifi_ap
+    print("[connect_wifi] Connecting to WiFi...")
+    _wifi_start = time.ticks_ms()
+    bssid = None
+    channel = None
+    rssi = -1000
+    for ssid, b, ch, r, security, hidden in wlan.scan():
+        if ssid.decode() == secrets.WIFI_SSID and r > rssi:
+            bssid = b
+            channel = ch
+            rssi = r
+    static_ip = getattr(secrets, "WIFI_STATIC_IP", None)
+    if static_ip:
+        wlan.ifconfig(static_ip)
+    if bssid:
+        wlan.connect(secrets.WIFI_SSID, secrets.WIFI_PASS, bssid=bssid, channel=channel)
+        _wifi_ap = (binascii.hexlify(bssid).decode(), channel)
+    else:
+        wlan.connect(secrets.WIFI_SSID, secrets.WIFI_PASS)
+        _wifi_ap = (None, None)
+    _wifi_join = 2
+
+def start_wifi():
+    """
+    Starts joining the WiFi using credentials from secrets.py and returns
+    without waiting, so other initialization can run meanwhile.
+    Tries a fast rejoin with the cached BSSID and channel first; without
+    a cache the AP scan of a full join runs before returning. With
+    WIFI_STATIC_IP set in secrets.py, DHCP is skipped entirely.
+
+    Returns:
+        network.WLAN object (possibly still associating, see wait_wifi())
+    """
+    global _wifi_join, _wifi_start, _wifi_cache
     wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
-    if not wlan.isconnected():
-        print("[connect_wifi] Connecting to WiFi...")
+    _wifi_join = 0
+    if wlan.isconnected():
+        return wlan
+    _wifi_cache = _load_wifi_cache()
+    if not _wifi_cache:
+        _full_join(wlan)
+        return wlan
+    print(f"[connect_wifi] Fast rejoin, bssid={_wifi_cache['bssid']}, channel={_wifi_cache['channel']}...")
+    static_ip = getattr(secrets, "WIFI_STATIC_IP", None)
+    if static_ip:
+        wlan.ifconfig(static_ip)
+    if _wifi_cache["bssid"]:
+        wlan.connect(
+            secrets.WIFI_SSID,
+            secrets.WIFI_PASS,
+            bssid=binascii.unhexlify(_wifi_cache["bssid"]),
+            channel=_wifi_cache["channel"],
+        )
+    else:
         wlan.connect(secrets.WIFI_SSID, secrets.WIFI_PASS)
-        retry = 0
-        while not wlan.isconnected():
-            time.sleep(0.5)
-            retry += 1
-            print(f"[connect_wifi] Retry {retry}/{WIFI_RETRIES}...")
-            if retry > WIFI_RETRIES:
-                raise RuntimeError("[connect_wifi] WiFi connection failed")
+    _wifi_join = 1
+    _wifi_start = time.ticks_ms()
+    return wlan
+
+def wait_wifi(wlan):
+    """
+    Waits for the join started by start_wifi(). A failed fast rejoin falls
+    back to a full join.
+
+    Args:
+        wlan: network.WLAN object returned by start_wifi().
+
+    Returns:
+        network.WLAN object (connected instance)
+
+    Raises:
+        RuntimeError if unable to connect within WIFI_TIMEOUT_MS.
+    """
+    if _wifi_join == 1 and not _wait_wifi(wlan, WIFI_FAST_JOIN_MS):
+        print("[connect_wifi] Fast rejoin failed")
+        # Reset the interface to abort the association
+        wlan.disconnect()
+        wlan.active(False)
+        wlan.active(True)
+        _full_join(wlan)
+    if not _wait_wifi(wlan, WIFI_TIMEOUT_MS):
+        raise RuntimeError("[connect_wifi] WiFi connection failed")
     print(f"[connect_wifi] Connected: {wlan.ifconfig()}")
+    if _wifi_join == 2:
+        _save_wifi_cache(_wifi_cache)
     return wlan
 
+def connect_wifi():
+    """
+    Connects to the WiFi using credentials from secrets.py, see start_wifi().
+
+    Returns:
+        network.WLAN object (connected instance)
+
+    Raises:
+        RuntimeError if unable to connect within WIFI_TIMEOUT_MS.
+    """
+    return wait_wifi(start_wifi())
+
+def resolve(host, port):
+    """
+    Resolves host and port to a socket address, with a cache that lasts
+    across reconnects. Used by the MQTT client instead of a DNS lookup on
+    every connect.
+
+    Args:
+        host (str): Host name or IP address.
+        port (int): Port number.
+
+    Returns:
+        Socket address for socket.connect().
+
+    Raises:
+        OSError if the lookup fails and nothing is cached.
+    """
+    entry = _dns_cache.get((host, port))
+    now = time.time()
+    if entry and now - entry[1] < MQTT_DNS_TTL:
+        return entry[0]
+    try:
+        addr = socket.getaddrinfo(host, port)[0][-1]
+    except OSError as e:
+        if entry:
+            print(f"[resolve] DNS lookup failed, using cached address: {e}")
+            return entry[0]
+        raise
+    _dns_cache[(host, port)] = (addr, now)
+    return addr
+
+def _tls_context():
+    """
+    Creates the TLS context for the broker once, if MQTT_TLS is set in
+    secrets.py. MQTT_CA names the CA certificate file to verify the
+    broker with; without it the connection is encrypted but the broker
+    is not verified, which is warned about.
+
+    Returns:
+        ssl.SSLContext object, or None without TLS.
+    """
+    global _tls_ctx
+    if _tls_ctx is None and getattr(secrets, "MQTT_TLS", False):
+        import ssl
+        _tls_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ca = getattr(secrets, "MQTT_CA", None)
+        if ca:
+            _tls_ctx.load_verify_locations(cafile=ca)
+            _tls_ctx.verify_mode = ssl.CERT_REQUIRED
+        else:
+            print("[connect_mqtt] WARNING: MQTT_CA not set, the broker certificate is not verified")
+            _tls_ctx.verify_mode = ssl.CERT_NONE
+    return _tls_ctx
+
 def connect_mqtt(client_id, callback, last_will_topic=None, last_will_message=None):
     """
     Connects to the MQTT broker using credentials from secrets.py.
@@ -69,6 +297,7 @@ def connect_mqtt(client_id, callback, last_will_topic=None, last_will_message=No
     Raises:
         RuntimeError if unable to connect after MQTT_RETRIES.
     """
+    global _tls_session
     print("[connect_mqtt] Connecting...")
     for attempt in range(MQTT_RETRIES):
         try:
@@ -78,15 +307,23 @@ def connect_mqtt(client_id, callback, last_will_topic=None, last_will_message=No
                 secrets.MQTT_PORT,
                 secrets.MQTT_USER,
                 secrets.MQTT_PASSWORD,
-                keepalive=7200
+                keepalive=MQTT_KEEPALIVE,
+                ssl=_tls_context(),
+                timeout_ms=MQTT_TIMEOUT_MS
             )
+            mqtt.resolve = resolve
+            mqtt.tls_session = _tls_session
             if (callback != None):
                 mqtt.set_callback(callback)
 
             if last_will_topic and last_will_message:
                 mqtt.set_last_will(last_will_topic, last_will_message)
 
+            start_ms = time.ticks_ms()
             mqtt.connect()
+            if mqtt.ssl:
+                _tls_session = mqtt.tls_session
+                print(f"[connect_mqtt] TLS session resumed={mqtt.tls_resumed}, connect took {time.ticks_diff(time.ticks_ms(), start_ms)} ms")
             print("[connect_mqtt] Connected to MQTT broker")
             return mqtt
         except Exception as e:
@@ -7,12 +7,17 @@ All constants must in UPPERCASE
 # ---- WIFI CONFIG ----
 WIFI_SSID = 'YourWiFiSSID'
 WIFI_PASS = 'YourWiFiPassword'
+# Optional static IP config (ip, subnet, gateway, dns), skips DHCP
+# WIFI_STATIC_IP = ('192.168.1.50', '255.255.255.0', '192.168.1.1', '192.168.1.1')
 
 # ---- MQTT CONFIG ----
 MQTT_BROKER = 'NNN.NNN.NNN.NNN'   
 MQTT_PORT = 1883
 MQTT_USER = 'mqtt_user'
 MQTT_PASSWORD = 'mqtt_password'
+# Optional TLS (use MQTT_PORT = 8883), set MQTT_CA to verify the broker
+# MQTT_TLS = True
+# MQTT_CA = 'ca.crt'
 
 # Home Assistant MQTT discovery topic prefix
 DISCOVERY_PREFIX = "homeassistant"
@@ -0,0 +1,369 @@
+# asyncio MQTT client with the same connect/publish/subscribe semantics
+# as umqtt.simple.MQTTClient. Runs under MicroPython asyncio and CPython.
+#
+#   async def main():
+#       mqtt = MQTTClient("hawe_demo", "192.168.1.10")
+#       mqtt.set_callback(on_message)
+#       await mqtt.connect()
+#       await mqtt.subscribe("hawe/demo/set")
+#       await mqtt.publish("hawe/demo/state", "ON", retain=True, qos=1)
+#
+# Incoming packets are handled by a receive task started by connect().
+# The callback may be a plain function or a coroutine function. A
+# coroutine callback runs in a task of its own, so it may publish with
+# QoS 1/2 or subscribe and wait for the ack; its errors are printed.
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import struct
+
+try:
+    from sys import print_exception
+except ImportError:
+    from traceback import print_exception
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+from .simple import MQTTException
+
+
+def _len(sz):
+    b = bytearray()
+    while sz > 0x7F:
+        b.append((sz & 0x7F) | 0x80)
+        sz >>= 7
+    b.append(sz)
+    return b
+
+
+def _str(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return struct.pack("!H", len(s)) + s
+
+
+class MQTTClient:
+    def __init__(
+        self,
+        client_id,
+        server,
+        port=0,
+        user=None,
+        password=None,
+        keepalive=0,
+        ssl=None,
+        max_missed_pings=2,
+    ):
+        if port == 0:
+            port = 8883 if ssl else 1883
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.max_missed_pings = max_missed_pings
+        self.pid = 0
+        self.cb = None
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_qos = 0
+        self.lw_retain = False
+        self.rtt = None
+        self.rtt_avg = None
+        self.missed_pings = 0
+        self._r = None
+        self._w = None
+        self._tasks = ()
+        self._err = None
+        # Held from write() until drain() completes
+        self._lock = asyncio.Lock()
+        # Running coroutine callbacks, see _run_cb()
+        self._cbtasks = set()
+        # pid -> Event of packets waiting for an ack, pid -> return code
+        self._acks = {}
+        self._rc = {}
+        # Inbound QoS 2 packet ids not yet released by the broker
+        self._inpid = set()
+        self._buf = bytearray()
+        self._pos = 0
+        self._tx = 0
+        self._ping_t = 0
+        self._pinging = False
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        assert topic
+        self.lw_topic = topic
+        self.lw_msg = msg
+        self.lw_qos = qos
+        self.lw_retain = retain
+
+    @property
+    def connected(self):
+        return self._w is not None and self._err is None
+
+    async def connect(self, clean_session=True):
+        if self.ssl:
+            self._r, self._w = await asyncio.open_connection(self.server, self.port, ssl=self.ssl)
+        else:
+            self._r, self._w = await asyncio.open_connection(self.server, self.port)
+        self._err = None
+        self._buf = bytearray()
+        self._pos = 0
+        self._pinging = False
+        self.missed_pings = 0
+        flags = clean_session << 1
+        payload = _str(self.client_id)
+        if self.lw_topic:
+            flags |= 0x4 | self.lw_qos << 3 | self.lw_retain << 5
+            payload += _str(self.lw_topic) + _str(self.lw_msg)
+        if self.user:
+            flags |= 0xC0
+            payload += _str(self.user) + _str(self.pswd)
+        assert self.keepalive < 65536
+        body = b"\0\x04MQTT\x04" + struct.pack("!BH", flags, self.keepalive) + payload
+        await self._send(b"\x10" + _len(len(body)) + body)
+        op, body = await self._read_pkt()
+        assert op == 0x20 and len(body) == 2
+        if body[1] != 0:
+            raise MQTTException(body[1])
+        self._tasks = [asyncio.create_task(self._recv_loop())]
+        if self.keepalive:
+            self._tasks.append(asyncio.create_task(self._ping_loop()))
+        return body[0] & 1
+
+    async def disconnect(self):
+        try:
+            await self._send(b"\xe0\0")
+        finally:
+            self._close(None)
+
+    async def ping(self):
+        await self._send(b"\xc0\0")
+        if not self._pinging:
+            self._ping_t = self._tx
+            self._pinging = True
+
+    # Publish a message. With QoS 1 and 2 this returns once the broker
+    # acknowledged (PUBACK) or completed (PUBCOMP) the message; other tasks
+    # keep running meanwhile.
+    async def publish(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        if isinstance(msg, str):
+            msg = msg.encode()
+        var = _str(topic)
+        if qos:
+            pid = self._next_pid()
+            var += struct.pack("!H", pid)
+            ev = self._acks[pid] = asyncio.Event()
+        await self._send(bytes([0x30 | qos << 1 | retain]) + _len(len(var) + len(msg)) + var + msg)
+        if qos:
+            await self._wait(pid, ev)
+            return pid
+
+    async def subscribe(self, topic, qos=0):
+        await self.subscribe_many(((topic, qos),))
+
+    async def subscribe_many(self, topics):
+        assert self.cb is not None, "Subscribe callback is not set"
+        body = b""
+        for t, q in topics:
+            body += _str(t) + bytes([q])
+        await self._send_sub(0x82, body)
+
+    async def unsubscribe(self, topic):
+        await self.unsubscribe_many((topic,))
+
+    async def unsubscribe_many(self, topics):
+        body = b""
+        for t in topics:
+            body += _str(t)
+        await self._send_sub(0xA2, body)
+
+    async def _send_sub(self, op, body):
+        pid = self._next_pid()
+        body = struct.pack("!H", pid) + body
+        ev = self._acks[pid] = asyncio.Event()
+        await self._send(bytes([op]) + _len(len(body)) + body)
+        await self._wait(pid, ev)
+        rc = self._rc.pop(pid, 0)
+        if rc >= 0x80:
+            raise MQTTException(rc)
+
+    def _next_pid(self):
+        self.pid = self.pid % 65535 + 1
+        return self.pid
+
+    async def _wait(self, pid, ev):
+        try:
+            await ev.wait()
+        finally:
+            self._acks.pop(pid, None)
+        if self._err:
+            raise self._err
+
+    # Every packet is written with a single write() call under the lock,
+    # so packets from concurrent tasks do not interleave and only one task
+    # at a time waits in drain().
+    async def _send(self, pkt):
+        async with self._lock:
+            if self._err:
+                raise self._err
+            self._w.write(pkt)
+            await self._w.drain()
+        self._tx = ticks_ms()
+
+    async def _read(self, n):
+        while len(self._buf) - self._pos < n:
+            d = await self._r.read(512)
+            if not d:
+                raise OSError(-1)
+            if self._pos:
+                self._buf = self._buf[self._pos :]
+                self._pos = 0
+            self._buf += d
+        i = self._pos
+        self._pos += n
+        return self._buf[i : i + n]
+
+    async def _read_pkt(self):
+        op = (await self._read(1))[0]
+        sz = 0
+        sh = 0
+        while 1:
+            b = (await self._read(1))[0]
+            sz |= (b & 0x7F) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+        return op, (await self._read(sz)) if sz else b""
+
+    async def _recv_loop(self):
+        try:
+            while 1:
+                op, body = await self._read_pkt()
+                await self._handle(op, body)
+        except Exception as e:
+            # Anything but a connection error comes from the callback or a
+            # malformed packet; report it, tasks waiting for an ack get it
+            # raised
+            if not isinstance(e, (OSError, asyncio.CancelledError)):
+                print_exception(e)
+            self._close(e)
+
+    async def _handle(self, op, body):
+        if op == 0xD0:  # PINGRESP
+            if self._pinging:
+                self.rtt = ticks_diff(ticks_ms(), self._ping_t)
+                self.rtt_avg = self.rtt if self.rtt_avg is None else (self.rtt_avg * 7 + self.rtt) // 8
+                self._pinging = False
+                self.missed_pings = 0
+            return
+        if op & 0xF0 == 0x30:
+            tl = body[0] << 8 | body[1]
+            topic = bytes(body[2 : 2 + tl])
+            i = 2 + tl
+            pid = 0
+            if op & 6:
+                pid = body[i] << 8 | body[i + 1]
+                i += 2
+            if op & 6 == 4:
+                if pid in self._inpid:
+                    await self._send(struct.pack("!BBH", 0x50, 2, pid))
+                    return
+                self._inpid.add(pid)
+            res = self.cb(topic, bytes(body[i:]))
+            if hasattr(res, "send"):
+                # Not awaited here: acks the callback waits for are read
+                # by this task
+                t = asyncio.create_task(self._run_cb(res, op, pid))
+                self._cbtasks.add(t)
+                return
+            await self._puback(op, pid)
+            return
+        pid = body[0] << 8 | body[1]
+        if op == 0x50:  # PUBREC
+            await self._send(struct.pack("!BBH", 0x62, 2, pid))
+            return
+        if op == 0x62:  # PUBREL
+            self._inpid.discard(pid)
+            await self._send(struct.pack("!BBH", 0x70, 2, pid))
+            return
+        # PUBACK, PUBCOMP, SUBACK, UNSUBACK
+        if len(body) > 2:
+            self._rc[pid] = max(body[2:])
+        ev = self._acks.get(pid)
+        if ev:
+            ev.set()
+
+    # Acknowledge an inbound PUBLISH once the callback is done with it.
+    async def _puback(self, op, pid):
+        if op & 6 == 2:
+            await self._send(struct.pack("!BBH", 0x40, 2, pid))
+        elif op & 6 == 4:
+            await self._send(struct.pack("!BBH", 0x50, 2, pid))
+
+    # Task running a coroutine callback. Its errors are printed and the
+    # message is acknowledged all the same.
+    async def _run_cb(self, coro, op, pid):
+        try:
+            await coro
+        except Exception as e:
+            print_exception(e)
+        try:
+            await self._puback(op, pid)
+        except OSError:
+            pass
+        finally:
+            self._cbtasks.discard(asyncio.current_task())
+
+    async def _ping_loop(self):
+        interval = self.keepalive * 500
+        while self._err is None:
+            await asyncio.sleep(interval / 4000)
+            now = ticks_ms()
+            if self._pinging:
+                if ticks_diff(now, self._ping_t) < interval:
+                    continue
+                self.missed_pings += 1
+                if self.missed_pings >= self.max_missed_pings:
+                    self._close(OSError(110))
+                    return
+                self._pinging = False
+                await self.ping()
+            elif ticks_diff(now, self._tx) >= interval:
+                await self.ping()
+
+    # Close the connection. Tasks waiting for an ack are woken and get
+    # err raised (or OSError if the connection was closed on purpose).
+    def _close(self, err):
+        if self._err is None:
+            self._err = err or OSError(-1)
+        if self._w:
+            try:
+                self._w.close()
+            except Exception:
+                pass
+        for ev in self._acks.values():
+            ev.set()
+        me = asyncio.current_task()
+        for t in self._tasks:
+            if t is not me:
+                t.cancel()
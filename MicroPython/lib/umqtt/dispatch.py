@@ -0,0 +1,131 @@
+# Topic filter dispatcher for umqtt.
+#
+#   d = Dispatcher()
+#   d.add("hawe/picostatus/cmd/+", on_command)
+#   d.add("hawe/#", on_any)
+#   mqtt.set_callback(d)
+#
+# Filters are kept in a byte-level trie, so incoming topics are matched
+# byte by byte (bytes or memoryview, see set_callback(zerocopy=True))
+# without decoding them to str. A node is a list
+# [children, handlers, plus, hash]: children maps a byte value to the
+# next node, handlers are those of a filter ending at the node, plus is
+# the node following a "+" level and hash the handlers of a "#" level.
+
+_SLASH = 0x2F
+_PLUS = 0x2B
+_HASH = 0x23
+_DOLLAR = 0x24
+
+
+def _node():
+    return [{}, None, None, None]
+
+
+class Dispatcher:
+    def __init__(self, default=None):
+        self._root = _node()
+        # Called as default(topic, msg) for messages no filter matches
+        self.default = default
+
+    # Register handler(topic, msg) for an MQTT topic filter.
+    def add(self, filt, handler):
+        if isinstance(filt, str):
+            filt = filt.encode()
+        node = self._root
+        n = len(filt)
+        i = 0
+        while i < n:
+            c = filt[i]
+            start = i == 0 or filt[i - 1] == _SLASH
+            end = i + 1 == n or filt[i + 1] == _SLASH
+            if start and end and c == _HASH:
+                assert i + 1 == n, "# must be the last level"
+                if node[3] is None:
+                    node[3] = []
+                node[3].append(handler)
+                return
+            if start and end and c == _PLUS:
+                if node[2] is None:
+                    node[2] = _node()
+                node = node[2]
+            else:
+                nxt = node[0].get(c)
+                if nxt is None:
+                    nxt = node[0][c] = _node()
+                node = nxt
+            i += 1
+        if node[1] is None:
+            node[1] = []
+        node[1].append(handler)
+
+    # Unregister a handler, or all handlers of the filter if none given.
+    def remove(self, filt, handler=None):
+        if isinstance(filt, str):
+            filt = filt.encode()
+        node = self._root
+        n = len(filt)
+        slot = 1
+        for i in range(n):
+            c = filt[i]
+            start = i == 0 or filt[i - 1] == _SLASH
+            end = i + 1 == n or filt[i + 1] == _SLASH
+            if start and end and c == _HASH:
+                slot = 3
+                break
+            node = node[2] if start and end and c == _PLUS else node[0].get(c)
+            if node is None:
+                return
+        hs = node[slot]
+        if hs:
+            if handler is None:
+                node[slot] = None
+            elif handler in hs:
+                hs.remove(handler)
+
+    # Dispatch a message, usable directly as the client callback.
+    # Returns the number of handlers called.
+    def __call__(self, topic, msg):
+        # Wildcards at the first level do not match topics starting with $
+        wild = len(topic) == 0 or topic[0] != _DOLLAR
+        n = self._level(self._root, topic, 0, msg, wild)
+        if not n and self.default:
+            self.default(topic, msg)
+        return n
+
+    # Match topic[i:], which starts a level, against node.
+    def _level(self, node, topic, i, msg, wild=True):
+        found = 0
+        n = len(topic)
+        if wild and node[3]:
+            found += self._call(node[3], topic, msg)
+        if wild and node[2] is not None:
+            j = i
+            while j < n and topic[j] != _SLASH:
+                j += 1
+            found += self._next(node[2], topic, j, msg)
+        j = i
+        while j < n and topic[j] != _SLASH:
+            node = node[0].get(topic[j])
+            if node is None:
+                return found
+            j += 1
+        return found + self._next(node, topic, j, msg)
+
+    # A level ended at topic[j], either the end of the topic or a "/".
+    def _next(self, node, topic, j, msg):
+        nxt = node[0].get(_SLASH)
+        if j < len(topic):
+            return self._level(nxt, topic, j + 1, msg) if nxt else 0
+        found = self._call(node[1], topic, msg)
+        # "a/#" also matches "a"
+        if nxt and nxt[3]:
+            found += self._call(nxt[3], topic, msg)
+        return found
+
+    def _call(self, handlers, topic, msg):
+        if not handlers:
+            return 0
+        for h in handlers:
+            h(topic, msg)
+        return len(handlers)
@@ -1,13 +1,95 @@
+import errno
+import random
+import select
 import time
 from . import simple
 
 
 class MQTTClient(simple.MQTTClient):
+    # Reconnect backoff: the first attempt after a connection loss waits
+    # up to DELAY seconds, the delay then doubles per failed attempt up
+    # to MAX_DELAY, randomized so that clients do not retry in lockstep.
+    # After BREAKER failed attempts in a row the circuit breaker opens
+    # and attempts are only made every MAX_DELAY.
     DELAY = 2
+    MAX_DELAY = 60
+    BREAKER = 5
+    # Time allowed for a reconnect attempt, from TCP connect to CONNACK
+    CONNECT_TIMEOUT = 10
     DEBUG = False
+    # Limits of the offline queue, in messages and payload bytes
+    QUEUE_LEN = 16
+    QUEUE_BYTES = 4096
 
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        # While the connection is down, publish() queues [topic, msg,
+        # retain, qos] entries here instead of blocking. A retained
+        # message replaces the queued one of the same topic. When the
+        # queue is full the oldest entries are dropped and counted.
+        self._queue = []
+        self._qbytes = 0
+        self._down = False
+        self.dropped = 0
+        # (entry, pid) of messages whose packets wait in the output
+        # buffer (coalesce, publish_many()). They go back to the queue if
+        # the flush fails.
+        self._held = []
+        # (op, topics) of subscribes and unsubscribes made while the
+        # connection was down, sent once it is back
+        self._subq = []
+        # Failed attempts since the connection was lost, successful
+        # reconnects and total time spent reconnecting in ms
+        self.attempts = 0
+        self.reconnects = 0
+        self.reconnect_ms = 0
+        self.session_present = 0
+        self._retry_t = 0
+        self._lost_t = None
+        self._err = None
+        # Reconnect state machine, advanced by poll(): 0 = waiting for
+        # the next attempt, 1 = TCP connect in progress, 2 = sending
+        # CONNECT (the TLS handshake runs as part of it), 3 = waiting
+        # for CONNACK. _cpkt[_cofs:] is the part of CONNECT not sent yet.
+        self._phase = 0
+        self._cpkt = None
+        self._cofs = 0
+        self._conn_t = 0
+
+    @property
+    def connected(self):
+        return not self._down
+
+    # Number of messages waiting in the offline queue.
+    def queued(self):
+        return len(self._queue)
+
+    # Circuit breaker state: "closed" while connected or retrying,
+    # "open" after BREAKER failed attempts until the next attempt is
+    # due, "half-open" from then on.
+    def breaker(self):
+        if self.attempts < self.BREAKER:
+            return "closed"
+        if time.ticks_diff(self._retry_t, time.ticks_ms()) > 0:
+            return "open"
+        return "half-open"
+
+    # Delay in ms after the i-th failed attempt, between half and all of
+    # DELAY * 2 ** (i - 1) seconds, capped at MAX_DELAY. Before the first
+    # attempt (i = 0) anywhere up to DELAY seconds.
+    def _backoff(self, i):
+        if not i:
+            return random.getrandbits(16) % (int(self.DELAY * 1000) + 1)
+        d = int(self.MAX_DELAY * 1000)
+        if i < self.BREAKER:
+            d = min(int(self.DELAY * 1000) << (i - 1), d)
+        return d - random.getrandbits(16) % (d // 2 + 1)
+
+    # Wait until the next attempt is due.
     def delay(self, i):
-        time.sleep(self.DELAY)
+        d = time.ticks_diff(self._retry_t, time.ticks_ms())
+        if d > 0:
+            time.sleep_ms(d)
 
     def log(self, in_reconnect, e):
         if self.DEBUG:
@@ -16,39 +98,272 @@ class MQTTClient(simple.MQTTClient):
             else:
                 print("mqtt: %r" % e)
 
-    def reconnect(self):
-        i = 0
-        while 1:
+    # Reconnect, retrying with backoff. With attempts given, gives up and
+    # raises the last error after that many failed attempts. With a
+    # deadline (ticks_ms) raises MQTTTimeout once the connection cannot
+    # be back by then.
+    def reconnect(self, attempts=0, deadline=None):
+        if not self._down:
+            self._down = True
+            self._phase = 0
+        n = self.attempts
+        while not self.poll():
+            if self.attempts != n:
+                n = self.attempts
+                attempts -= 1
+                if not attempts:
+                    raise self._err
+            if deadline is not None:
+                due = time.ticks_ms() if self._phase else self._retry_t
+                if time.ticks_diff(deadline, due) <= 0:
+                    raise simple.MQTTTimeout(errno.ETIMEDOUT)
+            if self._phase:
+                time.sleep_ms(10)
+            else:
+                self.delay(n)
+        return self.session_present
+
+    # Advance a reconnect by one step without blocking (except for the
+    # DNS lookup). Returns whether the client is connected. Called by
+    # check_msg(), or by the application while it has nothing to send.
+    def poll(self):
+        if not self._down:
+            return True
+        now = time.ticks_ms()
+        try:
+            if self._phase == 0:
+                if self._lost_t is None:
+                    self._lost_t = now
+                    self._retry_t = time.ticks_add(now, self._backoff(0))
+                if time.ticks_diff(self._retry_t, now) > 0:
+                    return False
+                if self.sock:
+                    self.sock.close()
+                # _open() discards the output buffer
+                self._requeue()
+                self._conn_t = now
+                self._open(blocking=False)
+                self._phase = 1
+            elif time.ticks_diff(now, self._conn_t) > self.CONNECT_TIMEOUT * 1000:
+                raise OSError(errno.ETIMEDOUT)
+            if self._phase == 1:
+                p = select.poll()
+                p.register(self.sock, select.POLLOUT)
+                ev = p.poll(0)
+                if not ev:
+                    return False
+                if ev[0][1] & (select.POLLERR | select.POLLHUP):
+                    raise OSError(errno.ECONNREFUSED)
+                self._wrap(False)
+                self._cpkt = self._connect_pkt(False)
+                self._cofs = 0
+                self._phase = 2
+            if self._phase == 2:
+                n = self.sock.write(self._cpkt[self._cofs :])
+                if n:
+                    self._cofs += n
+                if self._cofs < len(self._cpkt):
+                    return False
+                self._cpkt = None
+                self._phase = 3
+            op = self._parse()
+            if op is None:
+                if self._fill() is None:
+                    return False
+                op = self._parse()
+                if op is None:
+                    return False
+            # Connected, from here on the socket blocks as after connect()
+            self.sock.setblocking(True)
+            self.session_present = self._connack(op, False)
+            # Without a session _connack() restored all subscriptions
+            if self.session_present:
+                for s in self._subq:
+                    super()._send_sub(s[0], s[1], False)
+            self._subq = []
+        except (OSError, simple.MQTTException) as e:
+            self.log(True, e)
+            self._err = e
+            self._phase = 0
+            self._cpkt = None
+            self.attempts += 1
+            self._retry_t = time.ticks_add(time.ticks_ms(), self._backoff(self.attempts))
+            return False
+        self._phase = 0
+        self.reconnect_ms += time.ticks_diff(time.ticks_ms(), self._lost_t)
+        self._lost_t = None
+        self.attempts = 0
+        self.reconnects += 1
+        self._down = False
+        self._drain()
+        return not self._down
+
+    # Publishes while the connection is down (or older messages are
+    # still queued) go to the offline queue, sent after the next
+    # reconnect. Returns without blocking in that case. A QoS 1/2 message
+    # that was sent but not acknowledged stays in the in-flight table
+    # instead and is resent from there.
+    def publish(self, topic, msg, retain=False, qos=0):
+        if not (self._down or self._queue):
+            pid = self.pid
             try:
-                return super().connect(False)
+                return self._pub([topic, msg, retain, qos])
             except OSError as e:
-                self.log(True, e)
-                i += 1
-                self.delay(i)
+                self.log(False, e)
+                self._down = True
+            if self._inflight(pid):
+                return self.pid
+        self._enqueue(topic, msg, retain, qos)
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        while 1:
+    # Publish entry through simple.MQTTClient, keeping it in _held while
+    # its packet waits in the output buffer.
+    def _pub(self, m):
+        pid = super().publish(m[0], m[1], m[2], m[3])
+        if self._olen:
+            self._held.append((m, pid))
+        return pid
+
+    # Errors of the application's flush() (also the one ending
+    # publish_many()) mark the connection down, the messages of the
+    # burst are queued again.
+    def flush(self):
+        try:
+            self._flush()
+        except OSError as e:
+            self.log(False, e)
+            self._down = True
+
+    def _flush(self):
+        try:
+            super()._flush()
+        except OSError:
+            self._requeue()
+            raise
+        self._held = []
+
+    # Put the held messages, whose packets were not sent, back in front
+    # of the queue. QoS 1/2 ones still in the in-flight table are resent
+    # from there instead.
+    def _requeue(self):
+        held = self._held
+        if not held:
+            return
+        self._held = []
+        self._olen = 0
+        back = []
+        for m, pid in held:
+            if not (pid and self.pending(pid)):
+                msg = m[1].encode() if isinstance(m[1], str) else m[1]
+                back.append([m[0], msg, m[2], m[3]])
+                self._qbytes += len(msg)
+        self._queue[:0] = back
+        self._trim()
+
+    # Whether a publish that failed, started when the last packet id was
+    # pid, left its message in the in-flight table.
+    def _inflight(self, pid):
+        return self.pid != pid and self.pending(self.pid)
+
+    def _enqueue(self, topic, msg, retain, qos):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        n = len(msg)
+        if n > self.QUEUE_BYTES:
+            self.dropped += 1
+            return
+        if retain:
+            # Latest value wins
+            key = topic.name if isinstance(topic, simple.Topic) else topic
+            for e in self._queue:
+                if e[2] and (e[0].name if isinstance(e[0], simple.Topic) else e[0]) == key:
+                    self._qbytes += n - len(e[1])
+                    e[0] = topic
+                    e[1] = msg
+                    e[3] = qos
+                    n = -1
+                    break
+        if n >= 0:
+            self._queue.append([topic, msg, retain, qos])
+            self._qbytes += n
+        self._trim()
+
+    # Drop the oldest entries while the queue is over its limits.
+    def _trim(self):
+        while len(self._queue) > self.QUEUE_LEN or self._qbytes > self.QUEUE_BYTES:
+            self._qbytes -= len(self._queue.pop(0)[1])
+            self.dropped += 1
+
+    # Send the offline queue in one burst after a reconnect. Whatever is
+    # left (or not flushed) when the connection fails again stays queued.
+    def _drain(self):
+        q = self._queue
+        c = self.coalesce
+        self.coalesce = True
+        try:
+            while q:
+                m = q[0]
+                pid = self.pid
+                err = None
+                try:
+                    self._pub(m)
+                except OSError as e:
+                    if not self._inflight(pid):
+                        raise
+                    err = e
+                # Held messages may have been queued again in front
+                q.remove(m)
+                self._qbytes -= len(m[1])
+                if err:
+                    raise err
+            self._flush()
+        except OSError as e:
+            self.log(False, e)
+            self._down = True
+        finally:
+            self.coalesce = c
+
+    # Subscribes and unsubscribes do not block while the connection is
+    # down either, they are sent after the reconnect without waiting for
+    # the broker's ack.
+    def _send_sub(self, op, topics, wait=True):
+        if not wait:
+            return super()._send_sub(op, topics, False)
+        if not self._down:
             try:
-                return super().publish(topic, msg, retain, qos)
+                return super()._send_sub(op, topics)
             except OSError as e:
                 self.log(False, e)
-            self.reconnect()
+                self._down = True
+        self._subq.append((op, topics))
 
-    def wait_msg(self):
+    # Reconnects as needed. The deadline (or timeout_ms) covers the
+    # reconnects too, MQTTTimeout is raised once it has passed.
+    def wait_msg(self, deadline=None):
+        if deadline is None:
+            deadline = self._deadline()
         while 1:
+            if self._down:
+                self.reconnect(deadline=deadline)
             try:
-                return super().wait_msg()
+                return super().wait_msg(deadline)
+            except simple.MQTTTimeout:
+                raise
             except OSError as e:
                 self.log(False, e)
-            self.reconnect()
+            self._down = True
 
+    # While the connection is down this only advances the reconnect by
+    # one step and returns None, so the application loop keeps running.
     def check_msg(self, attempts=2):
         while attempts:
-            self.sock.setblocking(False)
+            if self._down and not self.poll():
+                return None
             try:
-                return super().wait_msg()
+                return super().check_msg()
             except OSError as e:
                 self.log(False, e)
-            self.reconnect()
+            self._down = True
             attempts -= 1
             
\ No newline at end of file
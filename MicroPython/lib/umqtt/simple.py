@@ -1,5 +1,7 @@
+import errno
 import socket
 import struct
+import time
 from binascii import hexlify
 
 
@@ -7,6 +9,83 @@ class MQTTException(Exception):
     pass
 
 
+# Raised when a blocking operation does not complete within the client's
+# timeout_ms. A timeout while waiting for a packet leaves the connection
+# usable, one in the middle of sending a packet closes the socket.
+class MQTTTimeout(OSError):
+    pass
+
+
+# Topic handle for publish(), holding the length prefixed topic as it is
+# sent in the PUBLISH variable header. Create once with MQTTClient.topic()
+# and reuse, so steady-state publishing does no per-call topic work.
+class Topic:
+    def __init__(self, name):
+        if isinstance(name, str):
+            name = name.encode()
+        self.name = name
+        self.enc = struct.pack("!H", len(name)) + name
+
+
+# Reader passed to the stream callback (see set_stream_callback()) for a
+# payload too large to buffer. Data is read through the receive buffer,
+# so memory use does not depend on the payload size. length is the
+# payload size, left the number of bytes not read yet. Whatever the
+# callback leaves unread is skipped.
+class PayloadReader:
+    def __init__(self, client):
+        self._c = client
+        self.length = 0
+        self.left = 0
+        self._dl = None
+
+    # Make at least one payload byte available in the receive buffer,
+    # return how many can be taken from it.
+    def _avail(self):
+        c = self._c
+        if c._rpos == c._rend:
+            c._rpos = c._rend = 0
+            c._recv(self._dl)
+        return min(self.left, c._rend - c._rpos)
+
+    # Read up to len(buf) bytes into buf, returns the number read, 0 at
+    # the end of the payload.
+    def readinto(self, buf):
+        if not self.left:
+            return 0
+        c = self._c
+        k = min(len(buf), self._avail())
+        buf[:k] = c._rmv[c._rpos : c._rpos + k]
+        c._rpos += k
+        self.left -= k
+        return k
+
+    # Read up to n bytes, b"" at the end of the payload.
+    def read(self, n=256):
+        if not self.left:
+            return b""
+        c = self._c
+        k = min(n, self._avail())
+        c._rpos += k
+        self.left -= k
+        return bytes(c._rmv[c._rpos - k : c._rpos])
+
+    # Discard n bytes, or the rest of the payload.
+    def skip(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        while n:
+            k = min(n, self._avail())
+            self._c._rpos += k
+            self.left -= k
+            n -= k
+
+    # Iterate over the payload in chunks of at most 256 bytes.
+    def __iter__(self):
+        while self.left:
+            yield self.read()
+
+
 class MQTTClient:
     def __init__(
         self,
@@ -18,6 +97,16 @@ class MQTTClient:
         keepalive=0,
         ssl=None,
         ssl_params={},
+        wbuf_size=256,
+        rbuf_size=256,
+        max_inflight=0,
+        retry_ms=5000,
+        max_payload=0,
+        overflow="drop",
+        max_missed_pings=2,
+        protocol=4,
+        obuf_size=512,
+        timeout_ms=0,
     ):
         if port == 0:
             port = 8883 if ssl else 1883
@@ -27,6 +116,17 @@ class MQTTClient:
         self.port = port
         self.ssl = ssl
         self.ssl_params = ssl_params
+        # TLS session of the last connection, offered on the next connect
+        # to skip the full handshake if the broker supports it.
+        # tls_resumed tells whether the last handshake was resumed. This
+        # needs an ssl module with sessions (SSLSocket.session, as in
+        # CPython). MicroPython's ssl has none: tls_session stays None
+        # and every connect does the full handshake.
+        self.tls_session = None
+        self.tls_resumed = False
+        # Optional resolve(server, port) returning the socket address,
+        # e.g. a caching resolver. Defaults to socket.getaddrinfo().
+        self.resolve = None
         self.pid = 0
         self.cb = None
         self.user = user
@@ -36,23 +136,421 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # Deadline for blocking operations (connect, writes, waiting for
+        # acks, wait_msg()), 0 for none. Raises MQTTTimeout when exceeded.
+        self.timeout_ms = timeout_ms
+        # Preallocated buffer for assembling outgoing packets
+        self._wbuf = bytearray(wbuf_size)
+        # Output buffer: with coalesce set (and always in publish_many()),
+        # packets are queued in _obuf[:_olen] and sent with one write by
+        # flush(), once the buffer is full or before waiting for a packet.
+        self.coalesce = False
+        self._obuf = bytearray(obuf_size)
+        self._olen = 0
+        # Receive buffer, unparsed data is kept in _rbuf[_rpos:_rend]. It
+        # grows to fit a larger packet and is shrunk back to rbuf_size
+        # once that packet was handled.
+        self._rsize = rbuf_size
+        self._rbuf = bytearray(rbuf_size)
+        self._rmv = memoryview(self._rbuf)
+        self._rpos = 0
+        self._rend = 0
+        self._rneed = 0
+        # Set while a zero-copy callback holds views into _rbuf, so the
+        # buffer contents are not moved
+        self._rpin = 0
+        # Inbound payloads above max_payload (or with a stream callback,
+        # packets larger than rbuf_size) are skipped and acknowledged.
+        # Otherwise, also in zero-copy mode, the receive buffer grows to
+        # fit the packet.
+        # overflow="raise" also raises MQTTException.
+        self.max_payload = max_payload
+        self.overflow = overflow
+        self._zc = False
+        # With a stream callback set, such payloads are passed to it as a
+        # PayloadReader instead of being dropped
+        self._scb = None
+        self._reader = PayloadReader(self)
+        self._rskip = 0
+        # Parser state, kept across calls so a partially received packet
+        # is resumed where it left off: 0 = header, 1 = length, 2 = body,
+        # 3 = skipping _rskip bytes of an oversized payload.
+        # _pop is the header byte, _plen the (partial) remaining length,
+        # _pofs the buffer offset of the body once complete.
+        self._pst = 0
+        self._pop = 0
+        self._plen = 0
+        self._psh = 0
+        self._pofs = 0
+        self._vend = 0
+        # Packet id and return code of the last received ack
+        self._rpid = 0
+        self._rcode = 0
+        # QoS 1/2 in-flight table. With max_inflight > 0, publish() returns
+        # the packet id without waiting for the broker; unacknowledged
+        # messages are retransmitted after retry_ms. Slots with pid 0 are
+        # free. The state of a slot is the header byte of the packet to
+        # resend: the PUBLISH header, or 0x62 (PUBREL) once a QoS 2
+        # message got its PUBREC.
+        self.max_inflight = max_inflight
+        self.retry_ms = retry_ms
+        self.ack_cb = None
+        n = max(max_inflight, 1)
+        self._ifn = 0
+        self._ifpid = [0] * n
+        self._ifst = bytearray(n)
+        self._ift = [0] * n
+        self._iftopic = [None] * n
+        self._ifmsg = [None] * n
+        # Packet ids of inbound QoS 2 messages delivered but not yet
+        # released by the broker, used to drop duplicates.
+        self._inpid = [0] * max(n, 4)
+        self._inidx = 0
+        self._abuf = bytearray(b"\0\x02\0\0")
+        # Keepalive: check_msg() sends a PINGREQ when nothing was sent for
+        # half the keepalive period. After max_missed_pings unanswered
+        # pings the connection is considered dead. rtt and rtt_avg hold
+        # the last and averaged time in ms from PINGREQ until the PINGRESP
+        # was processed. That is an upper bound of the broker round trip:
+        # check_msg() only sees the PINGRESP on its next call, so rtt
+        # includes the application's poll interval. It is close to the
+        # round trip only while the client waits in wait_msg().
+        self.max_missed_pings = max_missed_pings
+        self.rtt = None
+        self.rtt_avg = None
+        self.missed_pings = 0
+        self._tx = 0
+        self._ping_t = 0
+        self._pinging = False
+        # MQTT 5 mode (protocol=5): topics published more than once get a
+        # topic alias, up to the Topic Alias Maximum of the broker, and are
+        # then sent as alias only. _aliases maps topic -> alias, 0 for a
+        # topic seen once.
+        self.protocol = protocol
+        self._alias_max = 0
+        self._aliases = {}
+        self._alias_n = 0
+        self._alias_new = False
+        # Active subscriptions, topic filter -> qos. connect() restores
+        # them when the broker has no session for the client.
+        self._subs = {}
+
+    def _str(self, s):
+        if isinstance(s, str):
+            s = s.encode()
+        return struct.pack("!H", len(s)) + s
+
+    def _write(self, buf, n):
+        if self.coalesce:
+            ob = self._obuf
+            if self._olen + n > len(ob):
+                self._flush()
+            if n <= len(ob):
+                ob[self._olen : self._olen + n] = memoryview(buf)[:n]
+                self._olen += n
+                return
+        self._send(buf, n)
+
+    # Send the packets queued in the output buffer.
+    def flush(self):
+        self._flush()
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    # flush() for internal use, so umqtt.robust can treat errors of
+    # flushes by the application differently.
+    def _flush(self):
+        n = self._olen
+        if n:
+            self._olen = 0
+            self._send(self._obuf, n)
+
+    # Write buf[:n] to the socket, by deadline (timeout_ms if not given).
+    # Short writes are continued, so a packet is never sent truncated.
+    def _send(self, buf, n, deadline=None):
+        if deadline is None:
+            deadline = self._deadline()
+        mv = memoryview(buf)
+        i = 0
+        while i < n:
+            try:
+                self._block(deadline)
+            except MQTTTimeout:
+                if i:
+                    # Part of the packet is out, the stream is broken
+                    self.sock.close()
+                raise
+            try:
+                k = self.sock.write(mv[i:n])
+            except OSError:
+                # A timeout is raised as MQTTTimeout by _block()
+                if deadline is None or time.ticks_diff(deadline, time.ticks_ms()) > 0:
+                    raise
+                k = 0
+            if k:
+                i += k
+        self._tx = time.ticks_ms()
+
+    # Encode a remaining length into buf at offset i, return the next offset.
+    def _put_len(self, buf, i, sz):
+        while sz > 0x7F:
+            buf[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        return i + 1
 
-    def _recv_len(self):
+    # Read as much as is available from the socket into the receive
+    # buffer. Returns the number of bytes added, or None if a non-blocking
+    # socket has no data.
+    def _fill(self):
+        if self._olen:
+            self._flush()
+        buf = self._rbuf
+        n = self._rend - self._rpos
+        size = max(self._rneed, self._rsize, n)
+        if (
+            size > len(buf)
+            or self._rpin and self._rend == len(buf)
+            or size < len(buf) and not self._rpin
+        ):
+            # Move to a new buffer, either to fit a larger packet, to
+            # release the memory of one, or because views into the old
+            # one are still in use
+            buf = bytearray(size)
+            buf[:n] = self._rmv[self._rpos : self._rend]
+            self._rbuf = buf
+            self._rmv = memoryview(buf)
+            self._rpos = 0
+            self._rend = n
+        elif self._rpos and not self._rpin:
+            self._rmv[:n] = self._rmv[self._rpos : self._rend]
+            self._rpos = 0
+            self._rend = n
+        n = self.sock.readinto(self._rmv[self._rend :])
+        if n is None:
+            return None
+        if n == 0:
+            raise OSError(-1)
+        self._rend += n
+        return n
+
+    # Advance the parser over the buffered data. Header and length bytes
+    # are consumed as they arrive; returns the header byte once the whole
+    # body is buffered (at _pofs, _plen bytes), or None if more data is
+    # needed.
+    def _parse(self):
+        while 1:
+            buf = self._rbuf
+            end = self._rend
+            i = self._rpos
+            if self._pst == 3:
+                k = min(end - i, self._rskip)
+                self._rpos = i + k
+                self._rskip -= k
+                if self._rskip:
+                    return None
+                self._pst = 0
+                continue
+            if self._pst == 0:
+                if i >= end:
+                    return None
+                self._pop = buf[i]
+                self._plen = 0
+                self._psh = 0
+                self._pst = 1
+                i += 1
+            if self._pst == 1:
+                while 1:
+                    if i >= end:
+                        self._rpos = i
+                        return None
+                    b = buf[i]
+                    i += 1
+                    self._plen |= (b & 0x7F) << self._psh
+                    if not b & 0x80:
+                        break
+                    self._psh += 7
+                self._pst = 2
+            self._rpos = i
+            n = self._plen
+            big = self._scb and n > self._rsize
+            if self._pop & 0xF0 == 0x30 and (0 < self.max_payload < n or big):
+                # Possibly oversized PUBLISH, decide once topic and packet
+                # id are buffered (MQTT 5 properties count as payload)
+                hl = 2
+                if end - i >= 2:
+                    hl += (buf[i] << 8 | buf[i + 1]) + (2 if self._pop & 6 else 0)
+                if end - i < hl:
+                    self._rneed = hl
+                    return None
+                if 0 < self.max_payload < n - hl or big:
+                    if self._scb:
+                        self._stream(hl)
+                    else:
+                        self._overflow(hl)
+                    continue
+            if i + n > end:
+                self._rneed = n
+                return None
+            self._pst = 0
+            self._rneed = 0
+            self._pofs = i
+            self._rpos = i + n
+            return self._pop
+
+    # Drop the PUBLISH being parsed, its variable header of hl bytes is
+    # buffered. The message is acknowledged so the broker does not resend.
+    def _overflow(self, hl):
+        buf = self._rbuf
+        i = self._rpos
+        op = self._pop
+        pid = buf[i + hl - 2] << 8 | buf[i + hl - 1]
+        if self._rend - i >= self._plen:
+            self._rpos = i + self._plen
+            self._pst = 0
+        else:
+            self._rskip = self._plen - (self._rend - i)
+            self._rpos = self._rend
+            self._pst = 3
+        self._rneed = 0
+        self._puback(op, pid)
+        if self.overflow == "raise":
+            raise MQTTException("payload too large")
+
+    # Pass the PUBLISH being parsed to the stream callback, its variable
+    # header of hl bytes is buffered. Reads block until the payload is
+    # consumed, so the callback must not wait for other packets (e.g.
+    # publish with QoS 1) before it is done with the reader.
+    def _stream(self, hl):
+        i = self._rpos
+        op = self._pop
+        j = i + hl
+        pid = 0
+        if op & 6:
+            j -= 2
+            pid = self._rbuf[j] << 8 | self._rbuf[j + 1]
+        topic = bytes(self._rmv[i + 2 : j])
+        r = self._reader
+        r.length = r.left = self._plen - hl
+        self._rpos = i + hl
+        self._pst = 0
+        self._rneed = 0
+        r._dl = self._deadline()
+        if self.protocol == 5:
+            # Skip the properties, they are not passed on
+            n = sh = 0
+            while 1:
+                b = r.read(1)[0]
+                n |= (b & 0x7F) << sh
+                if not b & 0x80:
+                    break
+                sh += 7
+            r.skip(n)
+            r.length = r.left
+        try:
+            if not (op & 6 == 4 and pid in self._inpid):
+                self._scb(topic, r)
+        finally:
+            r.skip()
+        self._puback(op, pid)
+
+    # Deadline in ticks_ms for a blocking operation starting now, None
+    # without timeout_ms.
+    def _deadline(self):
+        if self.timeout_ms:
+            return time.ticks_add(time.ticks_ms(), self.timeout_ms)
+        return None
+
+    # Make the socket block until deadline, or without one indefinitely.
+    # Raises MQTTTimeout if deadline has passed.
+    def _block(self, deadline):
+        if deadline is None:
+            self.sock.setblocking(True)
+        else:
+            t = time.ticks_diff(deadline, time.ticks_ms())
+            if t <= 0:
+                raise MQTTTimeout(errno.ETIMEDOUT)
+            self.sock.settimeout(t / 1000)
+
+    # Blocking _fill(), raising MQTTTimeout once deadline has passed.
+    def _recv(self, deadline):
+        self._block(deadline)
+        try:
+            return self._fill()
+        except OSError as e:
+            if deadline is None or e.args[0] != errno.ETIMEDOUT:
+                raise
+            raise MQTTTimeout(errno.ETIMEDOUT)
+
+    # Block until a complete packet is buffered and parse it.
+    def _read_pkt(self, deadline=None):
+        op = self._parse()
+        while op is None:
+            self._recv(deadline)
+            op = self._parse()
+        return op
+
+    # With zerocopy set, f(topic, msg) gets memoryviews into the receive
+    # buffer instead of bytes copies. They are only valid during the call.
+    def set_callback(self, f, zerocopy=False):
+        self.cb = f
+        self._zc = zerocopy
+
+    # Set a callback f(topic, reader) for payloads above max_payload or
+    # packets larger than rbuf_size. reader is a PayloadReader, valid
+    # during the call only.
+    def set_stream_callback(self, f):
+        self._scb = f
+
+    # Read a variable byte integer at buf[j], returns the value and sets
+    # _vend to the offset after it.
+    def _varint(self, j):
+        buf = self._rbuf
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            b = buf[j]
+            j += 1
             n |= (b & 0x7F) << sh
             if not b & 0x80:
+                self._vend = j
                 return n
             sh += 7
 
-    def set_callback(self, f):
-        self.cb = f
+    # Offset after the MQTT 5 properties starting at buf[j].
+    def _skip_props(self, j):
+        n = self._varint(j)
+        return self._vend + n
+
+    # Pick the Topic Alias Maximum out of the CONNACK properties.
+    def _connack_props(self, j):
+        buf = self._rbuf
+        end = self._varint(j)
+        j = self._vend
+        end += j
+        while j < end:
+            p = buf[j]
+            j += 1
+            if p == 0x22:
+                self._alias_max = buf[j] << 8 | buf[j + 1]
+            if p in (0x13, 0x21, 0x22, 0x23):
+                j += 2
+            elif p in (0x02, 0x11, 0x18, 0x27):
+                j += 4
+            elif p == 0x0B:
+                self._varint(j)
+                j = self._vend
+            elif p == 0x26:
+                j += 2 + (buf[j] << 8 | buf[j + 1])
+                j += 2 + (buf[j] << 8 | buf[j + 1])
+            elif p in (0x03, 0x08, 0x09, 0x12, 0x15, 0x16, 0x1A, 0x1C, 0x1F):
+                j += 2 + (buf[j] << 8 | buf[j + 1])
+            else:
+                j += 1
+
+    # Set a callback f(pid) called when a QoS 1 publish is acknowledged
+    # or a QoS 2 publish is completed.
+    def set_ack_callback(self, f):
+        self.ack_cb = f
 
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
@@ -62,22 +560,83 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
+    # timeout (seconds) bounds the whole connect, up to the CONNACK. It
+    # defaults to timeout_ms.
     def connect(self, clean_session=True, timeout=None):
+        if timeout is None:
+            deadline = self._deadline()
+            if deadline is not None:
+                timeout = self.timeout_ms / 1000
+        else:
+            deadline = time.ticks_add(time.ticks_ms(), int(timeout * 1000))
+        self._open(timeout)
+        self._wrap()
+        pkt = self._connect_pkt(clean_session)
+        self._send(pkt, len(pkt), deadline)
+        return self._connack(self._read_pkt(deadline), clean_session)
+
+    # Connecting is split into steps so it can also run non-blocking
+    # (see umqtt.robust): _open() starts the TCP connection, _wrap()
+    # adds TLS, _connect_pkt() builds the CONNECT packet and _connack()
+    # processes the broker's answer.
+    def _open(self, timeout=None, blocking=True):
         self.sock = socket.socket()
+        if hasattr(socket, "TCP_NODELAY"):
+            # Packets are written whole, Nagle would only delay them, e.g.
+            # the CONNECT after a resumed TLS handshake until the broker's
+            # delayed ACK
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock.settimeout(timeout)
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
-        self.sock.connect(addr)
+        if self.resolve:
+            addr = self.resolve(self.server, self.port)
+        else:
+            addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        if not blocking:
+            self.sock.setblocking(False)
+        try:
+            self.sock.connect(addr)
+        except OSError as e:
+            if blocking or e.args[0] != errno.EINPROGRESS:
+                raise
+        self._rpos = self._rend = self._rneed = self._pst = self._rpin = 0
+        self._olen = 0
+
+    # With handshake False the TLS handshake happens during the first
+    # reads and writes, as needed on a non-blocking socket.
+    def _wrap(self, handshake=True):
         if self.ssl is True:
             # Legacy support for ssl=True and ssl_params arguments.
             import ssl
 
-            self.sock = ssl.wrap_socket(self.sock, **self.ssl_params)
+            if handshake:
+                self.sock = ssl.wrap_socket(self.sock, **self.ssl_params)
+            else:
+                self.sock = ssl.wrap_socket(self.sock, do_handshake=False, **self.ssl_params)
         elif self.ssl:
-            self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
+            kw = {"server_hostname": self.server}
+            if not handshake:
+                kw["do_handshake_on_connect"] = False
+            if self.tls_session is not None:
+                kw["session"] = self.tls_session
+            try:
+                self.sock = self.ssl.wrap_socket(self.sock, **kw)
+            except TypeError:
+                if "session" not in kw:
+                    raise
+                # TLS module without session resumption
+                del kw["session"]
+                self.tls_session = None
+                self.sock = self.ssl.wrap_socket(self.sock, **kw)
+
+    def _connect_pkt(self, clean_session):
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
 
         sz = 10 + 2 + len(self.client_id)
+        msg[5] = self.protocol
+        if self.protocol == 5:
+            # Empty CONNECT and will properties
+            sz += 2 if self.lw_topic else 1
         msg[6] = clean_session << 1
         if self.user:
             sz += 2 + len(self.user) + 2 + len(self.pswd)
@@ -98,123 +657,491 @@ class MQTTClient:
             i += 1
         premsg[i] = sz
 
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
+        pkt = premsg[: i + 2] + msg
+        if self.protocol == 5:
+            pkt += b"\0"
         # print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
+        pkt += self._str(self.client_id)
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
+            if self.protocol == 5:
+                pkt += b"\0"
+            pkt += self._str(self.lw_topic)
+            pkt += self._str(self.lw_msg)
         if self.user:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
+            pkt += self._str(self.user)
+            pkt += self._str(self.pswd)
+        return pkt
+
+    # Process the CONNACK parsed as op, returns the session present flag.
+    def _connack(self, op, clean_session):
+        i = self._pofs
+        assert op == 0x20 and self._plen >= 2
+        if self._rbuf[i + 1] != 0:
+            raise MQTTException(self._rbuf[i + 1])
+        self._alias_max = 0
+        self._aliases = {}
+        self._alias_n = 0
+        if self.protocol == 5:
+            self._connack_props(i + 2)
+        if self.ssl and self.ssl is not True:
+            # Handshake done, keep the session for the next connect
+            self.tls_resumed = getattr(self.sock, "session_reused", False)
+            self.tls_session = getattr(self.sock, "session", None)
+        self._tx = time.ticks_ms()
+        self._pinging = False
+        self.missed_pings = 0
+        sp = self._rbuf[i] & 1
+        if not sp and self._subs:
+            self._send_sub(0x82, list(self._subs.items()), False)
+        if clean_session:
+            for s in range(len(self._ifpid)):
+                self._ifpid[s] = 0
+                self._iftopic[s] = None
+                self._ifmsg[s] = None
+            self._ifn = 0
+        else:
+            # Resume the session, resend what was not acknowledged
+            self._retry(True)
+        return sp
 
     def disconnect(self):
-        self.sock.write(b"\xe0\0")
+        self._flush()
+        self._send(b"\xe0\0", 2)
         self.sock.close()
 
     def ping(self):
-        self.sock.write(b"\xc0\0")
+        self._write(b"\xc0\0", 2)
+        if not self._pinging:
+            self._ping_t = self._tx
+            self._pinging = True
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
-        if qos > 0:
+    # Called from check_msg(), keeps the connection alive and detects a
+    # broker that stopped answering.
+    def _keepalive(self):
+        now = time.ticks_ms()
+        interval = self.keepalive * 500
+        if self._pinging:
+            if time.ticks_diff(now, self._ping_t) < interval:
+                return
+            self.missed_pings += 1
+            if self.missed_pings >= self.max_missed_pings:
+                raise OSError(errno.ETIMEDOUT)
+            self._write(b"\xc0\0", 2)
+            self._ping_t = self._tx
+        elif time.ticks_diff(now, self._tx) >= interval:
+            self.ping()
+
+    # Publishes are assembled in the preallocated write buffer and sent
+    # with a single write. Payloads that do not fit are sent as a second
+    # write right after the header, topic and packet id.
+    def _send_publish(self, op, topic, msg, pid):
+        ml = len(msg)
+        i = self._pub_header(op, topic, ml, pid)
+        pkt = self._wbuf
+        if i + ml <= len(pkt):
+            pkt[i : i + ml] = msg
+            # print(hex(i + ml), hexlify(pkt[: i + ml], ":"))
+            self._write(pkt, i + ml)
+        else:
+            self._write(pkt, i)
+            self._write(msg, ml)
+
+    # Assemble the PUBLISH header for a payload of ml bytes in the write
+    # buffer, which is enlarged if the topic does not fit. Returns the
+    # header length.
+    def _pub_header(self, op, topic, ml, pid):
+        enc = None
+        if isinstance(topic, Topic):
+            enc = topic.enc
+            tl = len(enc) - 2
+        else:
+            tl = len(topic)
+        alias = 0
+        if self.protocol == 5 and self._alias_max:
+            alias = self._alias(topic)
+            if alias and not self._alias_new:
+                tl = 0
+        sz = 2 + tl + ml
+        if op & 6:
             sz += 2
-        assert sz < 2097152
-        i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
+        if self.protocol == 5:
+            sz += 4 if alias else 1
+        assert sz < 268435456
+        if len(self._wbuf) < 13 + tl:
+            self._wbuf = bytearray(13 + tl)
+        pkt = self._wbuf
+        pkt[0] = op
+        i = self._put_len(pkt, 1, sz)
+        if tl and enc:
+            pkt[i : i + 2 + tl] = enc
+        else:
+            pkt[i] = tl >> 8
+            pkt[i + 1] = tl & 0xFF
+            if tl:
+                pkt[i + 2 : i + 2 + tl] = topic
+        i += 2 + tl
+        if op & 6:
+            struct.pack_into("!H", pkt, i, pid)
+            i += 2
+        if alias:
+            # Properties: Topic Alias
+            pkt[i] = 3
+            pkt[i + 1] = 0x23
+            pkt[i + 2] = alias >> 8
+            pkt[i + 3] = alias & 0xFF
+            i += 4
+        elif self.protocol == 5:
+            pkt[i] = 0
             i += 1
-        pkt[i] = sz
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
-        if qos > 0:
-            self.pid += 1
+        return i
+
+    # Publish a payload of length bytes taken from source in chunks, for
+    # payloads too large to hold in RAM (files, sensor dumps). source is
+    # either an object with readinto(), read through the write buffer, or
+    # an iterable of bytes-like chunks, written as they come. QoS 1 and 2
+    # block until the broker acknowledged the message; as the payload is
+    # not kept it is not retransmitted. A source yielding fewer or more
+    # than length bytes raises OSError, the connection is unusable then.
+    def publish_stream(self, topic, length, source, retain=False, qos=0):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        assert 0 <= qos <= 2
+        pid = 0
+        if qos:
+            self.pid = self.pid % 65535 + 1
             pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+        i = self._pub_header(0x30 | qos << 1 | retain, topic, length, pid)
+        self._write(self._wbuf, i)
+        left = length
+        if hasattr(source, "readinto"):
+            mv = memoryview(self._wbuf)
+            while left:
+                n = source.readinto(mv[: min(left, len(mv))])
+                if not n:
+                    raise OSError(errno.EIO)
+                self._write(mv, n)
+                left -= n
+        else:
+            for chunk in source:
+                n = len(chunk)
+                if n > left:
+                    raise OSError(errno.EIO)
+                self._write(chunk, n)
+                left -= n
+            if left:
+                raise OSError(errno.EIO)
+        if qos:
+            ack = 0x40 if qos == 1 else 0x70
+            deadline = self._deadline()
+            while self._wait(deadline) != ack or self._rpid != pid:
+                pass
+            return pid
+
+    # Return a Topic handle for name, to be passed to publish().
+    def topic(self, name):
+        return Topic(name)
+
+    # Topic alias to use for topic (bytes or Topic), 0 for none. Sets _alias_new when the
+    # alias was just assigned and the topic must still be sent along.
+    def _alias(self, topic):
+        a = self._aliases.get(topic)
+        self._alias_new = False
+        if a is None:
+            self._aliases[topic] = 0
+            return 0
+        if a == 0:
+            if self._alias_n == self._alias_max:
+                return 0
+            self._alias_n += 1
+            a = self._aliases[topic] = self._alias_n
+            self._alias_new = True
+        return a
+
+    # With QoS 1 and 2 the message is kept in the in-flight table until
+    # its PUBACK or PUBCOMP arrives. Blocks until then, unless max_inflight
+    # is set, in which case it only blocks while the table is full. On
+    # MQTTTimeout the message stays in the table to be resent.
+    # Returns the packet id for QoS 1 and 2. topic is a str, bytes or a
+    # Topic handle from topic().
+    def publish(self, topic, msg, retain=False, qos=0):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        op = 0x30 | qos << 1 | retain
+        if qos == 0:
+            self._send_publish(op, topic, msg, 0)
+            return
+        assert qos <= 2
+        deadline = self._deadline()
+        while self._ifn == len(self._ifpid):
+            self._wait(deadline)
+            self._retry()
+        self.pid = self.pid % 65535 + 1
+        pid = self.pid
+        self._send_publish(op, topic, msg, pid)
+        s = self._ifpid.index(0)
+        self._ifpid[s] = pid
+        self._ifst[s] = op
+        self._ift[s] = time.ticks_ms()
+        self._iftopic[s] = topic
+        self._ifmsg[s] = msg
+        self._ifn += 1
+        if not self.max_inflight:
+            while self._ifpid[s] == pid:
+                self._wait(deadline)
+        return pid
+
+    # Publish a burst of (topic, msg, retain, qos) messages, coalesced in
+    # the output buffer and sent with as few writes as it allows. QoS 1/2
+    # messages only stay in the burst with max_inflight set, otherwise
+    # waiting for their ack flushes the buffer.
+    def publish_many(self, msgs):
+        c = self.coalesce
+        self.coalesce = True
+        try:
+            for topic, msg, retain, qos in msgs:
+                self.publish(topic, msg, retain, qos)
+        finally:
+            self.coalesce = c
+        self.flush()
+
+    # Number of unacknowledged QoS 1/2 messages, or with a pid given,
+    # whether that message is still in flight.
+    def pending(self, pid=0):
+        if pid:
+            return pid in self._ifpid
+        return self._ifn
+
+    # Retransmit in-flight messages older than retry_ms (all of them if
+    # force is set), PUBLISH with the DUP flag or PUBREL.
+    def _retry(self, force=False):
+        if not self._ifn:
+            return
+        now = time.ticks_ms()
+        for s in range(len(self._ifpid)):
+            pid = self._ifpid[s]
+            if pid and (force or time.ticks_diff(now, self._ift[s]) >= self.retry_ms):
+                if self._ifst[s] == 0x62:
+                    self._send_ack(0x62, pid)
+                else:
+                    self._send_publish(self._ifst[s] | 0x08, self._iftopic[s], self._ifmsg[s], pid)
+                self._ift[s] = now
+
+    def _send_ack(self, op, pid):
+        pkt = self._abuf
+        pkt[0] = op
+        pkt[2] = pid >> 8
+        pkt[3] = pid & 0xFF
+        self._write(pkt, 4)
+
+    def _acked(self, pid):
+        if pid not in self._ifpid:
+            return
+        s = self._ifpid.index(pid)
+        self._ifpid[s] = 0
+        self._iftopic[s] = None
+        self._ifmsg[s] = None
+        self._ifn -= 1
+        if self.ack_cb:
+            self.ack_cb(pid)
+
+    # PUBREC: the payload is no longer needed, move on to PUBREL.
+    def _received(self, pid):
+        if pid in self._ifpid:
+            s = self._ifpid.index(pid)
+            self._ifst[s] = 0x62
+            self._ift[s] = time.ticks_ms()
+            self._iftopic[s] = None
+            self._ifmsg[s] = None
+        self._send_ack(0x62, pid)
 
     def subscribe(self, topic, qos=0):
+        self.subscribe_many(((topic, qos),))
+
+    # Subscribe to a list of (topic, qos) filters with one SUBSCRIBE
+    # packet and wait for its SUBACK.
+    def subscribe_many(self, topics):
         assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+        topics = [(t.encode() if isinstance(t, str) else t, q) for t, q in topics]
+        for t, q in topics:
+            self._subs[t] = q
+        self._send_sub(0x82, topics)
+
+    def unsubscribe(self, topic):
+        self.unsubscribe_many((topic,))
+
+    # Unsubscribe from a list of topic filters with one UNSUBSCRIBE
+    # packet and wait for its UNSUBACK.
+    def unsubscribe_many(self, topics):
+        topics = [(t.encode() if isinstance(t, str) else t, None) for t in topics]
+        for t, q in topics:
+            self._subs.pop(t, None)
+        self._send_sub(0xA2, topics)
+
+    # Send a SUBSCRIBE or UNSUBSCRIBE (qos None) for a list of (topic, qos)
+    # and wait for the matching ack, unless wait is False.
+    def _send_sub(self, op, topics, wait=True):
+        sz = 3 if self.protocol == 5 else 2
+        for t, q in topics:
+            sz += 2 + len(t) + (q is not None)
+        pkt = self._wbuf
+        if len(pkt) < 5 + sz:
+            pkt = bytearray(5 + sz)
+        pkt[0] = op
+        i = self._put_len(pkt, 1, sz)
+        self.pid = self.pid % 65535 + 1
+        pid = self.pid
+        struct.pack_into("!H", pkt, i, pid)
+        i += 2
+        if self.protocol == 5:
+            pkt[i] = 0
+            i += 1
+        for t, q in topics:
+            tl = len(t)
+            pkt[i] = tl >> 8
+            pkt[i + 1] = tl & 0xFF
+            i += 2
+            pkt[i : i + tl] = t
+            i += tl
+            if q is not None:
+                pkt[i] = q
+                i += 1
+        # print(hex(i), hexlify(pkt[:i], ":"))
+        self._write(pkt, i)
+        deadline = self._deadline()
+        while wait:
+            res = self._wait(deadline)
+            if res == (op & 0xF0) + 0x10 and self._rpid == pid:
+                if self._rcode >= 0x80:
+                    raise MQTTException(self._rcode)
                 return
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
-    # messages processed internally.
-    def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
+    # messages processed internally. Waits at most timeout_ms, or
+    # until deadline (ticks_ms) if given.
+    def wait_msg(self, deadline=None):
+        if deadline is None:
+            deadline = self._deadline()
+        return self._wait(deadline)
+
+    # wait_msg() as used for acks by publish() and subscribe(). Not
+    # overridden by umqtt.robust, errors go to the caller.
+    def _wait(self, deadline):
+        res = self._handle(self._read_pkt(deadline))
+        self._flush()
+        return res
+
+    # Process a packet parsed by _parse(). The receive buffer position is
+    # already past the packet, so the callback may use the client freely.
+    def _handle(self, op):
+        buf = self._rbuf
+        i = self._pofs
+        if op == 0xD0:  # PINGRESP
+            assert self._plen == 0
+            if self._pinging:
+                self.rtt = time.ticks_diff(time.ticks_ms(), self._ping_t)
+                if self.rtt_avg is None:
+                    self.rtt_avg = self.rtt
+                else:
+                    self.rtt_avg = (self.rtt_avg * 7 + self.rtt) // 8
+                self._pinging = False
+                self.missed_pings = 0
             return None
-        op = res[0]
         if op & 0xF0 != 0x30:
+            if self._plen >= 2:
+                # PUBACK, SUBACK and friends start with the packet id,
+                # keep the highest (worst) return code that follows
+                self._rpid = buf[i] << 8 | buf[i + 1]
+                self._rcode = 0
+                j = i + 2
+                end = i + self._plen
+                if op == 0x90 or op == 0xB0:
+                    if self.protocol == 5:
+                        j = self._skip_props(j)
+                elif j < end:
+                    # MQTT 5 reason code, followed by properties
+                    end = j + 1
+                for j in range(j, end):
+                    if buf[j] > self._rcode:
+                        self._rcode = buf[j]
+                if op == 0x40 or op == 0x70:  # PUBACK, PUBCOMP
+                    self._acked(self._rpid)
+                elif op == 0x50:  # PUBREC
+                    self._received(self._rpid)
+                elif op == 0x62:  # PUBREL
+                    if self._rpid in self._inpid:
+                        self._inpid[self._inpid.index(self._rpid)] = 0
+                    self._send_ack(0x70, self._rpid)
             return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
+        end = i + self._plen
+        topic_len = buf[i] << 8 | buf[i + 1]
+        i += 2
+        j = i + topic_len
+        k = j
+        pid = 0
         if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
+            pid = buf[j] << 8 | buf[j + 1]
+            k += 2
+        if self.protocol == 5:
+            k = self._skip_props(k)
+        if op & 6 == 4 and pid in self._inpid:
+            # QoS 2 retransmission of a message not released yet, only
+            # acknowledge it again
+            self._send_ack(0x50, pid)
+            return op
+        if self._zc:
+            self._rpin += 1
+            try:
+                self.cb(self._rmv[i:j], self._rmv[k:end])
+            finally:
+                self._rpin -= 1
+        else:
+            self.cb(bytes(self._rmv[i:j]), bytes(self._rmv[k:end]))
+        self._puback(op, pid)
+        return op
+
+    # Acknowledge an inbound PUBLISH, QoS 2 packet ids are remembered
+    # until the broker's PUBREL.
+    def _puback(self, op, pid):
         if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
+            self._send_ack(0x40, pid)
         elif op & 6 == 4:
-            assert 0
-        return op
+            if pid not in self._inpid:
+                self._inpid[self._inidx] = pid
+                self._inidx = (self._inidx + 1) % len(self._inpid)
+            self._send_ack(0x50, pid)
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+    # the same processing as wait_msg, for every complete packet
+    # received with a single non-blocking read. A packet that
+    # is only partially received stays buffered and is resumed
+    # by the next call.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
+        self._retry()
+        if self.keepalive:
+            self._keepalive()
+        op = self._parse()
+        if op is None:
+            # Send what is queued (keepalive, acks for packets _parse()
+            # dropped) first, writes switch the socket back to blocking
+            self._flush()
+            self.sock.setblocking(False)
+            try:
+                n = self._fill()
+            finally:
+                # Only this read is non-blocking, writes while handling the
+                # packets must not be cut short
+                self.sock.setblocking(True)
+            if n is None:
+                return None
+            op = self._parse()
+        res = None
+        while op is not None:
+            res = self._handle(op)
+            op = self._parse()
+        self._flush()
+        return res